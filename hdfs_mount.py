@@ -1,3 +1,5 @@
+from collections import OrderedDict
+from contextlib import contextmanager
 import errno
 import logging
 import os
@@ -11,7 +13,8 @@ from hdfs.client import Client
 from hdfs.ext.kerberos import KerberosClient
 import yaml
 
-from utils import stat_to_attrs
+from locks import LockManager
+from utils import is_snapshot_path, stat_to_attrs
 
 
 log = logging.getLogger()
@@ -27,12 +30,27 @@ log.addHandler(ch)
 
 HDFS_BLOCK_SIZE = 2 * 27
 
+# Size of the content blocks kept in memory when the mount is immutable
+CACHE_BLOCK_SIZE = 2 ** 20
+
+# Default maximum total size (in bytes) of the content blocks kept in memory (least recently used are evicted first)
+CACHE_MAX_SIZE = 2 ** 28
+
+# Attribute/entry timeout (in seconds) given to the kernel when the mount is immutable
+IMMUTABLE_KERNEL_TIMEOUT = 24 * 3600
+
 
 class HDFS(Operations):
-    def __init__(self, hdfs_client: KerberosClient, hdfs_root, hdfs_user, hdfs_group):
+    def __init__(self, hdfs_client: KerberosClient, hdfs_root, hdfs_user, hdfs_group, immutable=False,
+                 block_cache_size=CACHE_MAX_SIZE):
         self.hdfs_client = hdfs_client
         self.hdfs_root = hdfs_root
 
+        # When the mounted data never changes (published datasets, HDFS snapshots), writes are refused
+        # and metadata and listings are cached forever. Content blocks are cached up to block_cache_size bytes.
+        self.immutable = immutable
+        self.block_cache_size = block_cache_size
+
         self.hdfs_user = hdfs_user
         self.hdfs_group = hdfs_group
 
@@ -44,14 +62,24 @@ class HDFS(Operations):
             'readdir': {
                 'last_path': '',
                 'last_resp': {},
-                'count_get': 0
-            }
+                'count_get': 0,
+                # Incremented on every mutation, so that a listing fetched before a concurrent mutation is not used
+                'generation': 0
+            },
+            # Only used when the mount is immutable (no TTL, only the blocks are evicted, in LRU order)
+            'status': {},
+            'list': {},
+            'blocks': OrderedDict(),
+            'blocks_size': 0,
         }
 
         # Bidirectional hashtable
         self.file_handle_fh = {}
         self.file_handle_p = {}
 
+        # Per-path readers-writer locks, plus global locks for the file handle tables and the caches
+        self._locks = LockManager()
+
     # Helpers
     # =======
 
@@ -60,6 +88,68 @@ class HDFS(Operations):
         path = os.path.join(self.hdfs_root, partial)
         return path
 
+    def _parent_path(self, path):
+        return '/' + '/'.join(path.lstrip('/').split('/')[:-1])
+
+    @contextmanager
+    def _mutating(self, *paths):
+        """
+        Takes the write lock of the given paths for a mutation, and then invalidates the last readdir listing
+        if the mutation may have changed it (getattr would otherwise answer from a stale listing).
+        """
+        try:
+            with self._locks.write(*[self._full_path(p) for p in paths]):
+                yield
+        finally:
+            with self._locks.cache:
+                self._cache['readdir']['generation'] += 1
+                last_path = self._cache['readdir']['last_path']
+                for p in paths:
+                    # The parent listing changes, and so does the listing of the path itself or of its subdirectories
+                    if last_path == self._parent_path(p) or (last_path + '/').startswith(p.rstrip('/') + '/'):
+                        self._cache['readdir']['last_path'] = ''
+
+    def _check_writable(self):
+        if self.immutable:
+            raise FuseOSError(errno.EROFS)
+
+    def _status(self, full_path):
+        """
+        Same as hdfs_client.status(full_path) but cached forever when the mount is immutable.
+        Missing paths are cached too and raise an HdfsError on each call.
+        """
+        if not self.immutable:
+            return self.hdfs_client.status(full_path)
+
+        with self._locks.cache:
+            cached = full_path in self._cache['status']
+            stat = self._cache['status'].get(full_path)
+        if not cached:
+            stat = self.hdfs_client.status(full_path, strict=False)
+            with self._locks.cache:
+                self._cache['status'][full_path] = stat
+        if stat is None:
+            raise HdfsError('File does not exist: {}'.format(full_path), exception='FileNotFoundException')
+        return stat
+
+    def _list(self, full_path):
+        """
+        Same as hdfs_client.list(full_path, status=True) but cached forever when the mount is immutable.
+        The status of every child is cached as well, so that the following getattr calls are free.
+        """
+        if not self.immutable:
+            return self.hdfs_client.list(full_path, status=True)
+
+        with self._locks.cache:
+            resp = self._cache['list'].get(full_path)
+        if resp is None:
+            resp = self.hdfs_client.list(full_path, status=True)
+            with self._locks.cache:
+                for name, stat in resp:
+                    self._cache['status'][os.path.join(full_path, name)] = stat
+                self._cache['list'][full_path] = resp
+        return resp
+
     # Filesystem methods
     # ==================
 
@@ -67,7 +157,11 @@ class HDFS(Operations):
         log.debug('access({}, {})'.format(path, mode))
         full_path = self._full_path(path)
 
-        stat = self.hdfs_client.status(full_path)
+        try:
+            with self._locks.read(full_path):
+                stat = self._status(full_path)
+        except HdfsError:
+            raise FuseOSError(errno.ENOENT)
 
         # TODO:
         # if not has_access(stat, mode):
@@ -78,11 +172,13 @@ class HDFS(Operations):
 
     def chmod(self, path, mode):
         log.debug('chmod({}, {})'.format(path, mode))
+        self._check_writable()
 
         full_path = self._full_path(path)
 
         try:
-            self.hdfs_client.set_permission(full_path, permission=oct(mode)[-3:])
+            with self._mutating(path):
+                self.hdfs_client.set_permission(full_path, permission=oct(mode)[-3:])
         except HdfsError as e:
             if e.exception == 'FileNotFoundException':
                 raise FuseOSError(errno.ENOENT)
@@ -91,6 +187,7 @@ class HDFS(Operations):
 
     def chown(self, path, uid, gid):
         log.debug('chown({}, {})'.format(uid, gid))
+        self._check_writable()
         full_path = self._full_path(path)
         self._cache['last_cmd'] = 'chown'
         raise FuseOSError(errno.ENOSYS)
@@ -105,21 +202,23 @@ class HDFS(Operations):
         full_path = self._full_path(path)
 
         # Use the cache if readdir has been call just before on the parent directory of the current path
-        parent_path = '/' + '/'.join(path.lstrip('/').split('/')[:-1])
-        if path != parent_path and self._cache['last_cmd'] == 'readdir' and self._cache['readdir'][
-            'last_path'] == parent_path:
-            if self._cache['readdir']['count_get'] >= len(self._cache['readdir']['last_resp']):
-                # TODO?
-                pass
-            try:
-                elem = self._cache['readdir']['last_resp'][path.split('/')[-1]]
-            except KeyError:
-                raise FuseOSError(errno.ENOENT)
-            self._cache['readdir']['count_get'] += 1
-            return stat_to_attrs(elem, self.hdfs_user, self.hdfs_group)
+        parent_path = self._parent_path(path)
+        with self._locks.cache:
+            if path != parent_path and self._cache['last_cmd'] == 'readdir' and self._cache['readdir'][
+                'last_path'] == parent_path:
+                if self._cache['readdir']['count_get'] >= len(self._cache['readdir']['last_resp']):
+                    # TODO?
+                    pass
+                try:
+                    elem = self._cache['readdir']['last_resp'][path.split('/')[-1]]
+                except KeyError:
+                    raise FuseOSError(errno.ENOENT)
+                self._cache['readdir']['count_get'] += 1
+                return stat_to_attrs(elem, self.hdfs_user, self.hdfs_group)
 
         try:
-            stat = self.hdfs_client.status(full_path)
+            with self._locks.read(full_path):
+                stat = self._status(full_path)
         except HdfsError:
             raise FuseOSError(errno.ENOENT)
 
@@ -137,22 +236,29 @@ class HDFS(Operations):
 
         full_path = self._full_path(path)
 
+        with self._locks.cache:
+            generation = self._cache['readdir']['generation']
+
         try:
-            resp = self.hdfs_client.list(full_path, status=True)
+            with self._locks.read(full_path):
+                resp = self._list(full_path)
         except HdfsError:
             raise FuseOSError(errno.EACCES)
         # ls = [a for a, _ in resp]
         ls_stat = {b['pathSuffix']: b for _, b in resp}
 
-        self._cache['readdir']['last_path'] = path
-        self._cache['readdir']['last_resp'] = ls_stat
-        self._cache['readdir']['count_get'] = 0
+        with self._locks.cache:
+            # The listing may miss a concurrent mutation: in that case, it must not be used by getattr
+            if self._cache['readdir']['generation'] == generation:
+                self._cache['readdir']['last_path'] = path
+                self._cache['readdir']['last_resp'] = ls_stat
+                self._cache['readdir']['count_get'] = 0
+                self._cache['last_cmd'] = 'readdir'
 
         # FIXME: needed? (this does not seem to be a problem to omit that when browsing the FS)
         # yield '.', to_attrs(stat.S_IFDIR | stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR, 0, 0, 0, 0, 0, 0, 0), 0
         # yield '..', to_attrs(stat.S_IFDIR | stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR, 0, 0, 0, 0, 0, 0, 0), 0
 
-        self._cache['last_cmd'] = 'readdir'
         for i, r in enumerate(resp):
             attrs = stat_to_attrs(r[1], self.hdfs_user, self.hdfs_group)
             # FIXME: what to return for the third parameter? Always zero?
@@ -172,6 +278,7 @@ class HDFS(Operations):
 
     def mknod(self, path, mode, dev):
         log.debug('mknod({}, {}, {})'.format(path, mode, dev))
+        self._check_writable()
         #
         # full_path = self._full_path(path)
 
@@ -182,22 +289,26 @@ class HDFS(Operations):
 
     def rmdir(self, path):
         log.debug('rmdir({})'.format(path))
+        self._check_writable()
 
         full_path = self._full_path(path)
 
         self._cache['last_cmd'] = 'rmdir'
 
         try:
-            self.hdfs_client.delete(full_path, recursive=True)
+            with self._mutating(path):
+                self.hdfs_client.delete(full_path, recursive=True)
         except HdfsError:
             raise FuseOSError(errno.ENOENT)
 
     def mkdir(self, path, mode):
         log.debug('mkdir({}, {})'.format(path, mode))
+        self._check_writable()
 
         full_path = self._full_path(path)
 
-        self.hdfs_client.makedirs(full_path, permission=oct(mode)[-3:])
+        with self._mutating(path):
+            self.hdfs_client.makedirs(full_path, permission=oct(mode)[-3:])
 
         self._cache['last_cmd'] = 'mkdir'
         return 0
@@ -215,28 +326,33 @@ class HDFS(Operations):
 
     def unlink(self, path):
         log.debug('unlink({})'.format(path))
+        self._check_writable()
         full_path = self._full_path(path)
 
         self._cache['last_cmd'] = 'unlink'
         try:
-            self.hdfs_client.delete(full_path, recursive=False)
+            with self._mutating(path):
+                self.hdfs_client.delete(full_path, recursive=False)
         except HdfsError:
             raise FuseOSError(errno.ENOENT)
 
     def symlink(self, name, target):
         log.debug('symlink({}, {})'.format(name, target))
+        self._check_writable()
         self._cache['last_cmd'] = 'symlink'
         raise FuseOSError(errno.ENOSYS)
         # return os.symlink(name, self._full_path(target))
 
     def rename(self, old, new):
         log.debug('rename({}, {})'.format(old, new))
+        self._check_writable()
 
         full_old_path = self._full_path(old)
         full_new_path = self._full_path(new)
 
         try:
-            self.hdfs_client.rename(full_old_path, full_new_path)
+            with self._mutating(old, new):
+                self.hdfs_client.rename(full_old_path, full_new_path)
         except HdfsError as e:
             if e.exception == 'AccessControlException':
                 raise FuseOSError(errno.EACCES)
@@ -247,12 +363,14 @@ class HDFS(Operations):
 
     def link(self, target, name):
         log.debug('link({}, {})'.format(target, name))
+        self._check_writable()
         self._cache['last_cmd'] = 'link'
         raise FuseOSError(errno.ENOSYS)
         # return os.link(self._full_path(target), self._full_path(name))
 
     def utimens(self, path, times=None):
         log.debug('utimens({}, {})'.format(path, times))
+        self._check_writable()
 
         full_path = self._full_path(path)
 
@@ -260,7 +378,8 @@ class HDFS(Operations):
         mt = int(times[1] * 1000)
 
         try:
-            self.hdfs_client.set_times(full_path, access_time=at, modification_time=mt)
+            with self._mutating(path):
+                self.hdfs_client.set_times(full_path, access_time=at, modification_time=mt)
         except HdfsError as e:
             if e.exception == 'IOException':
                 log.debug(e)
@@ -274,32 +393,50 @@ class HDFS(Operations):
 
     def _open(self, full_path, size, is_new_file):
 
-        fh = 42
-        while fh in self.file_handle_fh:
-            fh += 1
+        with self._locks.handles:
+            fh = 42
+            while fh in self.file_handle_fh:
+                fh += 1
 
-        self.file_handle_fh[fh] = {
-            'full_path': full_path,
-            'actions': [],
-        }
+            self.file_handle_fh[fh] = {
+                'full_path': full_path,
+                'actions': [],
+            }
 
-        if full_path in self.file_handle_p:
-            self.file_handle_p[full_path]['fhs'].append(fh)
-        else:
+            if full_path in self.file_handle_p:
+                self.file_handle_p[full_path]['fhs'].append(fh)
+                return fh
+
+        # The temporary file is created outside of the handles lock, as it does disk I/O.
+        # Nothing can be written on an immutable mount, so there is no need for a temporary file.
+        tf = None
+        if not self.immutable:
             tf = tempfile.TemporaryFile()
             tf.truncate(size)
-            self.file_handle_p[full_path] = {
-                'fhs': [fh],
-                'tmp': tf,
-                'written_parts': [],
-                'is_new_file': is_new_file
-            }
+
+        with self._locks.handles:
+            # Another thread may have opened the same file in the meantime
+            already_open = full_path in self.file_handle_p
+            if already_open:
+                self.file_handle_p[full_path]['fhs'].append(fh)
+            else:
+                self.file_handle_p[full_path] = {
+                    'fhs': [fh],
+                    'tmp': tf,
+                    'written_parts': [],
+                    'is_new_file': is_new_file
+                }
+
+        if already_open and tf is not None:
+            tf.close()
 
         return fh
 
     def _check_is_open(self, full_path, fh=None):
-        if full_path not in self.file_handle_p or (fh is not None and fh not in self.file_handle_p[full_path]['fhs']):
-            raise FuseOSError(errno.ENOENT)
+        with self._locks.handles:
+            if full_path not in self.file_handle_p or (
+                    fh is not None and fh not in self.file_handle_p[full_path]['fhs']):
+                raise FuseOSError(errno.ENOENT)
 
     def open(self, path, flags):
         """
@@ -309,6 +446,8 @@ class HDFS(Operations):
         :return: The file descriptor (int)
         """
         log.debug('open({}, {})'.format(path, flags))
+        if flags & (os.O_WRONLY | os.O_RDWR | os.O_TRUNC | os.O_APPEND):
+            self._check_writable()
         full_path = self._full_path(path)
 
         fh = self._open(full_path, self.getattr(path)['st_size'], is_new_file=False)
@@ -325,6 +464,7 @@ class HDFS(Operations):
         :return: The file descriptor (int)
         """
         log.debug('create({}, {}, {})'.format(path, mode, fi))
+        self._check_writable()
         full_path = self._full_path(path)
 
         fh = self._open(full_path, 0, is_new_file=True)
@@ -332,16 +472,17 @@ class HDFS(Operations):
         # self.file_handle_fh[fh]['actions'].append(('create', (mode)))
 
         try:
-            self.hdfs_client.write(
-                full_path,
-                data=b'',
-                overwrite=False,
-                permission=oct(mode)[-3:],
-                blocksize=None,
-                buffersize=None,
-                append=None,
-                encoding='utf-8'
-            )
+            with self._mutating(path):
+                self.hdfs_client.write(
+                    full_path,
+                    data=b'',
+                    overwrite=False,
+                    permission=oct(mode)[-3:],
+                    blocksize=None,
+                    buffersize=None,
+                    append=None,
+                    encoding='utf-8'
+                )
         except HdfsError as e:
             if e.exception == 'FileAlreadyExistsException':
                 raise FuseOSError(errno.EEXIST)
@@ -371,14 +512,50 @@ class HDFS(Operations):
             log.debug("Unhandled exception: ", e.exception)
             raise FuseOSError(errno.ENOSYS)
 
+    def _read_from_blocks(self, full_path, offset, length):
+        """
+        Reads the file through the in-memory blocks cache (immutable mount only).
+        Each block of CACHE_BLOCK_SIZE bytes is fetched from HDFS on first access and kept until the total size
+        of the cached blocks exceeds block_cache_size, the least recently used blocks being evicted first.
+        """
+        size = self._status(full_path)['length']
+        end = min(offset + length, size)
+        if offset >= end:
+            return b''
+
+        res = b''
+        for block in range(offset // CACHE_BLOCK_SIZE, (end - 1) // CACHE_BLOCK_SIZE + 1):
+            key = (full_path, block)
+            with self._locks.cache:
+                data = self._cache['blocks'].get(key)
+                if data is not None:
+                    self._cache['blocks'].move_to_end(key)
+            if data is None:
+                # Two threads may fetch the same block concurrently: this is harmless since the data never changes
+                block_start = block * CACHE_BLOCK_SIZE
+                data = self._read_from_hdfs(full_path, block_start, min(CACHE_BLOCK_SIZE, size - block_start))
+                with self._locks.cache:
+                    if key not in self._cache['blocks']:
+                        self._cache['blocks'][key] = data
+                        self._cache['blocks_size'] += len(data)
+                        while self._cache['blocks_size'] > self.block_cache_size:
+                            _, evicted = self._cache['blocks'].popitem(last=False)
+                            self._cache['blocks_size'] -= len(evicted)
+            res += data
+
+        start = offset - (offset // CACHE_BLOCK_SIZE) * CACHE_BLOCK_SIZE
+        return res[start:start + end - offset]
+
     def _get_parts(self, parts, fs, fe):
         if len(parts) == 0:
             return [], []
 
         # First, merge parts:
         def merge(times):
+            # Parts are stored in the order they were written, so they must be sorted before being merged
+            times = sorted([sorted(t) for t in times])
             saved = list(times[0])
-            for st, en in sorted([sorted(t) for t in times]):
+            for st, en in times:
                 if st <= saved[1]:
                     saved[1] = max(saved[1], en)
                 else:
@@ -412,53 +589,76 @@ class HDFS(Operations):
                 continue
 
             read_from_tmp.append((ps, pe, rs, re))
+        # Gaps between the written parts, as [start, end) intervals like the parts
         read_from_hdfs = []
         if len(read_from_tmp) > 0:
             cp = fs
             for _, _, a, b in sorted(read_from_tmp, key=lambda x: x[3]):
                 assert cp <= a
                 if a != cp:
-                    read_from_hdfs.append((cp, a - 1))
-                cp = b + 1
+                    read_from_hdfs.append((cp, a))
+                cp = b
+            if cp < fe:
+                read_from_hdfs.append((cp, fe))
         return read_from_tmp, read_from_hdfs
 
     def read(self, path, length, offset, fh):
         log.debug('read({}, {}, {}, {})'.format(path, length, offset, fh))
         full_path = self._full_path(path)
-        self._check_is_open(full_path, fh)
+        with self._locks.read(full_path):
+            self._check_is_open(full_path, fh)
 
-        result = b'\0' * length
+            if self.immutable:
+                self._cache['last_cmd'] = 'read'
+                return self._read_from_blocks(full_path, offset, length)
 
-        # Find out where:
-        # -> we read from hdfs
-        # -> we read from the temporary file that already has written parts
+            tmp_fd = self.file_handle_p[full_path]['tmp'].fileno()
 
-        read_from_tmp, read_from_hdfs = self._get_parts(
-            self.file_handle_p[full_path]['written_parts'],
-            offset,
-            offset + length)
+            # Find out where:
+            # -> we read from hdfs
+            # -> we read from the temporary file that already has written parts
 
-        for ps, pe, rs, re in read_from_tmp:
-            self.file_handle_p[full_path]['tmp'].seek(rs)
-            result[ps:pe] = self.file_handle_p[full_path]['tmp'].read(rs - re)
+            # The temporary file always has the current size of the file
+            end = min(offset + length, os.fstat(tmp_fd).st_size)
 
-        if len(read_from_tmp) > 0:
-            for a, b in read_from_tmp:
-                result[a:b] = self._read_from_hdfs(full_path, a, b - a)
-        else:
-            result = self._read_from_hdfs(full_path, offset, length)
+            read_from_tmp, read_from_hdfs = self._get_parts(
+                self.file_handle_p[full_path]['written_parts'],
+                offset,
+                end)
+
+            if len(read_from_tmp) > 0:
+                result = bytearray(max(end - offset, 0))
+
+                # pread does not move the file position, so concurrent readers of the same file do not interfere
+                for _, _, rs, re in read_from_tmp:
+                    result[rs - offset:re - offset] = os.pread(tmp_fd, re - rs, rs)
+
+                # Past the end of the file on HDFS (the file has been extended), the result stays zero-filled
+                hdfs_size = self._status(full_path)['length']
+                for a, b in read_from_hdfs:
+                    b = min(b, hdfs_size)
+                    if a < b:
+                        data = self._read_from_hdfs(full_path, a, b - a)
+                        result[a - offset:a - offset + len(data)] = data
+
+                result = bytes(result)
+            else:
+                result = self._read_from_hdfs(full_path, offset, length)
 
         self._cache['last_cmd'] = 'read'
         return result
 
     def write(self, path, buf, offset, fh):
         log.debug('write({}, {}, {})'.format(path, offset, fh))
+        self._check_writable()
         full_path = self._full_path(path)
-        self._check_is_open(full_path, fh)
 
         self._cache['last_cmd'] = 'write'
 
-        self.file_handle_fh[fh]['actions'].append(('write', (offset, buf)))
+        with self._locks.write(full_path):
+            self._check_is_open(full_path, fh)
+            with self._locks.handles:
+                self.file_handle_fh[fh]['actions'].append(('write', (offset, buf)))
 
         return len(buf)
 
@@ -473,6 +673,7 @@ class HDFS(Operations):
         """
 
         log.debug('truncate({}, {}, {})'.format(path, length, fh))
+        self._check_writable()
         full_path = self._full_path(path)
 
         # if length>current_length, add \0 bytes
@@ -483,11 +684,12 @@ class HDFS(Operations):
             self.flush(path, fh)
             self.release(path, fh)
         else:
-            self._check_is_open(full_path, fh)
+            with self._mutating(path):
+                self._check_is_open(full_path, fh)
 
-            self.file_handle_p[full_path]['tmp'].truncate(length)
-            self.file_handle_p[full_path]['tmp'].flush()
-            os.fsync(self.file_handle_p[full_path]['tmp'].fileno())
+                self.file_handle_p[full_path]['tmp'].truncate(length)
+                self.file_handle_p[full_path]['tmp'].flush()
+                os.fsync(self.file_handle_p[full_path]['tmp'].fileno())
 
         self._cache['last_cmd'] = 'truncate'
 
@@ -498,20 +700,31 @@ class HDFS(Operations):
         full_path = self._full_path(path)
         self._check_is_open(full_path, fh)
 
-        for action in self.file_handle_fh[fh]['actions']:
-            if action[0] == 'write':
-                offset, buf = action[1]
+        # flush is called on every close(), including for read-only handles: only take the write lock (and so wait
+        # for the in-flight reads of this file) when there is something to write
+        with self._locks.handles:
+            has_actions = fh in self.file_handle_fh and len(self.file_handle_fh[fh]['actions']) > 0
+        if not has_actions:
+            self._cache['last_cmd'] = 'flush'
+            return 0
 
-                self.file_handle_p[full_path]['tmp'].seek(offset)
-                self.file_handle_p[full_path]['tmp'].write(buf)
-                self.file_handle_p[full_path]['tmp'].flush()
-                #os.fsync(self.file_handle_p[full_path]['tmp'].fileno())
+        with self._mutating(path):
+            self._check_is_open(full_path, fh)
+
+            for action in self.file_handle_fh[fh]['actions']:
+                if action[0] == 'write':
+                    offset, buf = action[1]
+
+                    self.file_handle_p[full_path]['tmp'].seek(offset)
+                    self.file_handle_p[full_path]['tmp'].write(buf)
+                    self.file_handle_p[full_path]['tmp'].flush()
+                    #os.fsync(self.file_handle_p[full_path]['tmp'].fileno())
 
-                self.file_handle_p[full_path]['written_parts'].append((offset, offset + len(buf)))
+                    self.file_handle_p[full_path]['written_parts'].append((offset, offset + len(buf)))
 
-        if len(self.file_handle_fh[fh]['actions']) > 0:
-            self.fsync(path, None, fh)
-        self.file_handle_fh[fh]['actions'] = []
+            if len(self.file_handle_fh[fh]['actions']) > 0:
+                self._fsync(full_path)
+            self.file_handle_fh[fh]['actions'] = []
 
         self._cache['last_cmd'] = 'flush'
         return 0
@@ -520,7 +733,22 @@ class HDFS(Operations):
         log.debug('fsync({}, {}, {})'.format(path, fdatasync, fh))
         self._cache['last_cmd'] = 'fsync'
         full_path = self._full_path(path)
-        self._check_is_open(full_path, fh)
+
+        # Nothing can have been written on an immutable mount
+        if self.immutable:
+            self._check_is_open(full_path, fh)
+            return 0
+
+        with self._mutating(path):
+            self._check_is_open(full_path, fh)
+            return self._fsync(full_path)
+
+    def _fsync(self, full_path):
+        """
+        Sends the temporary file to HDFS. The caller must hold the write lock of full_path.
+        """
+        if self.file_handle_p[full_path]['tmp'] is None:
+            return 0
 
         self.file_handle_p[full_path]['tmp'].seek(0, 2)
         size = self.file_handle_p[full_path]['tmp'].tell()
@@ -528,9 +756,13 @@ class HDFS(Operations):
         read_from_tmp, read_from_hdfs = self._get_parts(self.file_handle_p[full_path]['written_parts'], 0, size)
 
         if len(read_from_tmp) > 0:
+            # Past the end of the file on HDFS (the file has been extended), the temporary file is already zero-filled
+            hdfs_size = self._status(full_path)['length']
             for a, b in read_from_hdfs:
-                self.file_handle_p[full_path]['tmp'].seek(a)
-                self.file_handle_p[full_path]['tmp'].write(self._read_from_hdfs(full_path, a, b))
+                b = min(b, hdfs_size)
+                if a < b:
+                    self.file_handle_p[full_path]['tmp'].seek(a)
+                    self.file_handle_p[full_path]['tmp'].write(self._read_from_hdfs(full_path, a, b - a))
 
             self.file_handle_p[full_path]['tmp'].seek(0)
             data = self.file_handle_p[full_path]['tmp'].read()
@@ -554,14 +786,18 @@ class HDFS(Operations):
         log.debug('release({}, {})'.format(path, fh))
         self._cache['last_cmd'] = 'release'
         full_path = self._full_path(path)
-        self._check_is_open(full_path, fh)
 
-        self.file_handle_p[full_path]['fhs'].remove(fh)
+        # Only bookkeeping is done here (pending writes are sent by flush), so the path lock is not needed
+        with self._locks.handles:
+            if full_path not in self.file_handle_p or fh not in self.file_handle_p[full_path]['fhs']:
+                raise FuseOSError(errno.ENOENT)
+
+            self.file_handle_p[full_path]['fhs'].remove(fh)
 
-        del self.file_handle_fh[fh]
+            del self.file_handle_fh[fh]
 
-        if len(self.file_handle_p[full_path]['fhs']) == 0:
-            del self.file_handle_p[full_path]
+            if len(self.file_handle_p[full_path]['fhs']) == 0:
+                del self.file_handle_p[full_path]
 
         return 0
  
@@ -590,12 +826,22 @@ if __name__ == '__main__':
     hdfs_mount_root = cfg['hdfs']['mount_root']
     hdfs_user = cfg['hdfs']['hdfs_user']
     hdfs_group = cfg['hdfs']['hdfs_group']
+    # Snapshots can not be modified, so mounting one always implies the immutable mode
+    hdfs_immutable = cfg['hdfs'].get('immutable', False) or is_snapshot_path(hdfs_mount_root)
+    hdfs_block_cache_size = cfg['hdfs'].get('block_cache_size', CACHE_MAX_SIZE)
     mount_dest_dir = cfg['mount']['dest_dir']
     if 'extra' in cfg['mount']:
         mount_extra_params = cfg['mount']['extra']
     else:
         mount_extra_params = {}
 
+    if hdfs_immutable:
+        log.info('Mounting {} as immutable (read-only, metadata cached forever)'.format(hdfs_mount_root))
+        mount_extra_params.setdefault('ro', True)
+        mount_extra_params.setdefault('kernel_cache', True)
+        mount_extra_params.setdefault('attr_timeout', IMMUTABLE_KERNEL_TIMEOUT)
+        mount_extra_params.setdefault('entry_timeout', IMMUTABLE_KERNEL_TIMEOUT)
+
     if not os.path.isdir(mount_dest_dir):
         print('Directory {0} does not exists, please specify an existing directory.'.format(mount_dest_dir))
         exit(1)
@@ -605,5 +851,6 @@ if __name__ == '__main__':
     else:
         hdfs_client = Client(hdfs_server)
 
-    operations = HDFS(hdfs_client, hdfs_mount_root, hdfs_user, hdfs_group)
+    operations = HDFS(hdfs_client, hdfs_mount_root, hdfs_user, hdfs_group, immutable=hdfs_immutable,
+                      block_cache_size=hdfs_block_cache_size)
     FUSE(operations, mountpoint=mount_dest_dir, raw_fi=False, foreground=True, **mount_extra_params)
@@ -0,0 +1,104 @@
+from contextlib import contextmanager
+import threading
+
+
+class RWLock:
+    """
+    A readers-writer lock: any number of readers, or a single writer.
+    Writers have priority, so that a continuous flow of reads can not starve them.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+
+    def acquire_read(self):
+        with self._cond:
+            while self._writer or self._waiting_writers > 0:
+                self._cond.wait()
+            self._readers += 1
+
+    def release_read(self):
+        with self._cond:
+            self._readers -= 1
+            if self._readers == 0:
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        with self._cond:
+            self._waiting_writers += 1
+            while self._writer or self._readers > 0:
+                self._cond.wait()
+            self._waiting_writers -= 1
+            self._writer = True
+
+    def release_write(self):
+        with self._cond:
+            self._writer = False
+            self._cond.notify_all()
+
+
+class LockManager:
+    """
+    Hands out per-path readers-writer locks, plus short global locks:
+    - handles: protects the file handle tables (fh allocation, open/release bookkeeping)
+    - cache: protects the shared metadata/content caches
+
+    The global locks must never be held during network I/O, and never be held while acquiring a path lock.
+    Per-path locks are created on demand and dropped as soon as nobody uses them anymore.
+    """
+
+    def __init__(self):
+        self.handles = threading.Lock()
+        self.cache = threading.Lock()
+
+        self._paths_lock = threading.Lock()
+        # path -> [RWLock, number of users]
+        self._paths = {}
+
+    def _get(self, path):
+        with self._paths_lock:
+            if path not in self._paths:
+                self._paths[path] = [RWLock(), 0]
+            self._paths[path][1] += 1
+            return self._paths[path][0]
+
+    def _put(self, path):
+        with self._paths_lock:
+            self._paths[path][1] -= 1
+            if self._paths[path][1] == 0:
+                del self._paths[path]
+
+    @contextmanager
+    def read(self, path):
+        lock = self._get(path)
+        try:
+            lock.acquire_read()
+            try:
+                yield
+            finally:
+                lock.release_read()
+        finally:
+            self._put(path)
+
+    @contextmanager
+    def write(self, *paths):
+        """
+        Takes the write lock of every given path. Locks are always taken in the same (sorted) order to avoid deadlocks.
+        """
+        paths = sorted(set(paths))
+        acquired = []
+        try:
+            for path in paths:
+                lock = self._get(path)
+                acquired.append((path, lock, False))
+                lock.acquire_write()
+                acquired[-1] = (path, lock, True)
+            yield
+        finally:
+            for path, lock, locked in reversed(acquired):
+                if locked:
+                    lock.release_write()
+                self._put(path)
@@ -0,0 +1,358 @@
+from contextlib import contextmanager
+import errno
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from fuse import FuseOSError
+from hdfs import HdfsError
+
+from hdfs_mount import HDFS
+
+
+class FakeClient:
+    """
+    In-memory stand-in for hdfs.client.Client: files are stored as bytes, directories as a set of paths.
+    """
+
+    def __init__(self, files=None, dirs=()):
+        self.files = dict(files or {})
+        self.dirs = set(dirs)
+        self.reads = []
+        # Called at the end of each list(), to simulate a concurrent operation
+        self.on_list = None
+
+    def _stat(self, hdfs_path):
+        is_dir = hdfs_path in self.dirs
+        return {
+            'pathSuffix': os.path.basename(hdfs_path),
+            'owner': 'user',
+            'group': 'group',
+            'permission': '755' if is_dir else '644',
+            'type': 'DIRECTORY' if is_dir else 'FILE',
+            'length': 0 if is_dir else len(self.files[hdfs_path]),
+            'accessTime': 0,
+            'modificationTime': 0,
+        }
+
+    def status(self, hdfs_path, strict=True):
+        hdfs_path = hdfs_path.rstrip('/')
+        if hdfs_path not in self.files and hdfs_path not in self.dirs:
+            if strict:
+                raise HdfsError('File does not exist: {}'.format(hdfs_path), exception='FileNotFoundException')
+            return None
+        return self._stat(hdfs_path)
+
+    def list(self, hdfs_path, status=False):
+        hdfs_path = hdfs_path.rstrip('/')
+        children = sorted(p for p in self.files.keys() | self.dirs if os.path.dirname(p) == hdfs_path)
+        resp = [(os.path.basename(p), self._stat(p)) for p in children]
+        if self.on_list is not None:
+            self.on_list()
+        return resp
+
+    @contextmanager
+    def read(self, hdfs_path, offset=0, length=None, **kwargs):
+        data = self.files[hdfs_path]
+        if offset > len(data):
+            raise HdfsError('Cannot seek after EOF', exception='EOFException')
+        self.reads.append((hdfs_path, offset, length))
+        yield [data[offset:offset + length]]
+
+    def write(self, hdfs_path, data=None, overwrite=False, **kwargs):
+        if hdfs_path in self.files and not overwrite:
+            raise HdfsError('File exists', exception='FileAlreadyExistsException')
+        self.files[hdfs_path] = data
+
+    def delete(self, hdfs_path, recursive=False):
+        self.files.pop(hdfs_path, None)
+        self.dirs.discard(hdfs_path)
+
+    def makedirs(self, hdfs_path, permission=None):
+        self.dirs.add(hdfs_path)
+
+
+class GetPartsTest(unittest.TestCase):
+    def setUp(self):
+        self.ops = HDFS(FakeClient(), '/root', 'user', 'group')
+
+    def test_no_parts(self):
+        self.assertEqual(self.ops._get_parts([], 0, 10), ([], []))
+
+    def test_gaps_are_half_open(self):
+        read_from_tmp, read_from_hdfs = self.ops._get_parts([(5, 10)], 0, 20)
+        self.assertEqual(read_from_tmp, [(5, 10, 5, 10)])
+        self.assertEqual(read_from_hdfs, [(0, 5), (10, 20)])
+
+    def test_parts_are_clipped_to_the_range(self):
+        read_from_tmp, read_from_hdfs = self.ops._get_parts([(0, 10)], 3, 7)
+        self.assertEqual(read_from_tmp, [(0, 10, 3, 7)])
+        self.assertEqual(read_from_hdfs, [])
+
+    def test_out_of_order_parts_are_merged(self):
+        read_from_tmp, read_from_hdfs = self.ops._get_parts([(10, 20), (0, 5), (4, 8)], 0, 30)
+        self.assertEqual(read_from_tmp, [(0, 8, 0, 8), (10, 20, 10, 20)])
+        self.assertEqual(read_from_hdfs, [(8, 10), (20, 30)])
+
+
+class ReadWriteTest(unittest.TestCase):
+    def setUp(self):
+        self.client = FakeClient(files={'/root/f': bytes(range(100))}, dirs={'/root'})
+        self.ops = HDFS(self.client, '/root', 'user', 'group')
+        self.fh = self.ops.open('/f', os.O_RDWR)
+
+    def tearDown(self):
+        self.ops.release('/f', self.fh)
+        self.assertEqual(self.ops.file_handle_fh, {})
+        self.assertEqual(self.ops.file_handle_p, {})
+
+    def test_read_without_writes(self):
+        self.assertEqual(self.ops.read('/f', 10, 5, self.fh), bytes(range(5, 15)))
+
+    def test_write_in_the_middle(self):
+        self.ops.write('/f', b'XY', 3, self.fh)
+        self.ops.flush('/f', self.fh)
+
+        expected = bytes(range(3)) + b'XY' + bytes(range(5, 100))
+        self.assertEqual(self.client.files['/root/f'], expected)
+        for offset in (0, 2, 3, 4, 50, 99, 100):
+            for length in (0, 1, 2, 5, 200):
+                self.assertEqual(self.ops.read('/f', length, offset, self.fh), expected[offset:offset + length])
+
+    def test_out_of_order_writes(self):
+        self.ops.write('/f', b'ZZ', 50, self.fh)
+        self.ops.flush('/f', self.fh)
+        self.ops.write('/f', b'YYYYY', 0, self.fh)
+        self.ops.flush('/f', self.fh)
+
+        expected = b'YYYYY' + bytes(range(5, 50)) + b'ZZ' + bytes(range(52, 100))
+        self.assertEqual(self.client.files['/root/f'], expected)
+        self.assertEqual(self.ops.read('/f', 100, 0, self.fh), expected)
+
+    def test_extended_file(self):
+        self.ops.truncate('/f', 150, self.fh)
+        self.ops.write('/f', b'XY', 120, self.fh)
+        self.ops.flush('/f', self.fh)
+
+        expected = bytes(range(100)) + b'\0' * 20 + b'XY' + b'\0' * 28
+        self.assertEqual(self.client.files['/root/f'], expected)
+        self.assertEqual(self.ops.read('/f', 200, 0, self.fh), expected)
+
+    def test_extended_then_partly_rewritten_file(self):
+        client = FakeClient(files={'/root/g': b'a' * 10}, dirs={'/root'})
+        ops = HDFS(client, '/root', 'user', 'group')
+        fh = ops.open('/g', os.O_RDWR)
+        ops.truncate('/g', 100, fh)
+        ops.write('/g', b'b' * 20, 0, fh)
+
+        ops.flush('/g', fh)
+
+        self.assertEqual(client.files['/root/g'], b'b' * 20 + b'\0' * 80)
+        ops.release('/g', fh)
+
+
+class OpenReleaseTest(unittest.TestCase):
+    def setUp(self):
+        self.client = FakeClient(files={'/root/f': b'abc'}, dirs={'/root'})
+        self.ops = HDFS(self.client, '/root', 'user', 'group')
+
+    def test_concurrent_open_of_the_same_file(self):
+        temporary_file = tempfile.TemporaryFile
+        created = []
+        other_fh = []
+
+        def create_temporary_file():
+            tf = temporary_file()
+            created.append(tf)
+            if len(created) == 1:
+                # Another thread opens the same file while this one creates its temporary file
+                other_fh.append(self.ops.open('/f', os.O_RDONLY))
+            return tf
+
+        with mock.patch('hdfs_mount.tempfile.TemporaryFile', side_effect=create_temporary_file):
+            fh = self.ops.open('/f', os.O_RDONLY)
+
+        self.assertCountEqual(self.ops.file_handle_p['/root/f']['fhs'], [fh, other_fh[0]])
+        self.assertIs(self.ops.file_handle_p['/root/f']['tmp'], created[1])
+        self.assertTrue(created[0].closed)
+
+        self.ops.release('/f', fh)
+        self.ops.release('/f', other_fh[0])
+        self.assertEqual(self.ops.file_handle_p, {})
+
+    def test_closing_read_only_handle_does_not_wait_for_reads(self):
+        fh = self.ops.open('/f', os.O_RDONLY)
+
+        def close():
+            self.ops.flush('/f', fh)
+            self.ops.release('/f', fh)
+
+        # An in-flight read holds the read lock of the path
+        with self.ops._locks.read('/root/f'):
+            thread = threading.Thread(target=close, daemon=True)
+            thread.start()
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+
+        self.assertEqual(self.ops.file_handle_fh, {})
+
+    def test_release_of_unknown_handle(self):
+        with self.assertRaises(FuseOSError) as cm:
+            self.ops.release('/f', 42)
+        self.assertEqual(cm.exception.errno, errno.ENOENT)
+
+
+class ReaddirCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.client = FakeClient(files={'/root/d/a': b'abc'}, dirs={'/root', '/root/d'})
+        self.ops = HDFS(self.client, '/root', 'user', 'group')
+
+    def assertNotFound(self, path):
+        with self.assertRaises(FuseOSError) as cm:
+            self.ops.getattr(path)
+        self.assertEqual(cm.exception.errno, errno.ENOENT)
+
+    def test_getattr_uses_the_last_listing(self):
+        list(self.ops.readdir('/d', None))
+        self.client.files['/root/d/b'] = b''
+
+        # b was added behind the back of the mount, so it is not in the listing
+        self.assertNotFound('/d/b')
+        self.assertEqual(self.ops.getattr('/d/a')['st_size'], 3)
+
+    def test_mutations_invalidate_the_listing(self):
+        list(self.ops.readdir('/d', None))
+        fh = self.ops.create('/d/b', 0o644)
+        self.assertEqual(self.ops.getattr('/d/b')['st_size'], 0)
+        self.ops.release('/d/b', fh)
+
+        list(self.ops.readdir('/d', None))
+        self.ops.unlink('/d/a')
+        self.assertNotFound('/d/a')
+
+        list(self.ops.readdir('/d', None))
+        self.ops.rmdir('/d')
+        self.assertEqual(self.ops._cache['readdir']['last_path'], '')
+
+    def test_mutations_elsewhere_keep_the_listing(self):
+        list(self.ops.readdir('/d', None))
+        self.ops.mkdir('/e', 0o755)
+        self.assertEqual(self.ops._cache['readdir']['last_path'], '/d')
+
+    def test_listing_fetched_before_a_concurrent_mutation_is_not_used(self):
+        fhs = []
+
+        def create():
+            self.client.on_list = None
+            fhs.append(self.ops.create('/d/b', 0o644))
+
+        self.client.on_list = create
+        list(self.ops.readdir('/d', None))
+
+        self.assertEqual(self.ops.getattr('/d/b')['st_size'], 0)
+        self.ops.release('/d/b', fhs[0])
+
+
+class ImmutableTest(unittest.TestCase):
+    DATA = bytes(range(13))
+
+    def setUp(self):
+        self.client = FakeClient(files={'/root/d/f': self.DATA}, dirs={'/root', '/root/d'})
+        self.ops = HDFS(self.client, '/root', 'user', 'group', immutable=True)
+
+        patcher = mock.patch('hdfs_mount.CACHE_BLOCK_SIZE', 4)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_read_across_blocks(self):
+        fh = self.ops.open('/d/f', os.O_RDONLY)
+        for offset in range(len(self.DATA) + 2):
+            for length in range(len(self.DATA) + 2):
+                self.assertEqual(self.ops.read('/d/f', length, offset, fh), self.DATA[offset:offset + length])
+
+        # Each of the 4 blocks is fetched only once
+        self.assertEqual(sorted(offset for _, offset, _ in self.client.reads), [0, 4, 8, 12])
+        self.assertEqual(self.ops._cache['blocks_size'], len(self.DATA))
+        self.ops.release('/d/f', fh)
+
+    def test_block_cache_is_bounded(self):
+        self.ops.block_cache_size = 8
+        fh = self.ops.open('/d/f', os.O_RDONLY)
+
+        self.assertEqual(self.ops.read('/d/f', 13, 0, fh), self.DATA)
+        self.assertEqual(list(self.ops._cache['blocks']), [('/root/d/f', 2), ('/root/d/f', 3)])
+        self.assertEqual(self.ops._cache['blocks_size'], 5)
+
+        # Block 2 is now the most recently used, so block 3 is evicted first
+        self.assertEqual(self.ops.read('/d/f', 2, 8, fh), self.DATA[8:10])
+        self.assertEqual(self.ops.read('/d/f', 4, 0, fh), self.DATA[0:4])
+        self.assertEqual(list(self.ops._cache['blocks']), [('/root/d/f', 2), ('/root/d/f', 0)])
+        self.assertEqual(self.ops._cache['blocks_size'], 8)
+        self.ops.release('/d/f', fh)
+
+    def test_metadata_is_cached(self):
+        with mock.patch.object(self.client, 'status', wraps=self.client.status) as status:
+            self.ops.getattr('/d')
+            self.ops.getattr('/d')
+            self.ops.access('/d', os.R_OK)
+            self.assertEqual(status.call_count, 1)
+
+    def test_listing_is_cached_with_the_status_of_its_children(self):
+        with mock.patch.object(self.client, 'list', wraps=self.client.list) as list_, \
+                mock.patch.object(self.client, 'status', wraps=self.client.status) as status:
+            self.assertEqual([name for name, _, _ in self.ops.readdir('/d', None)], ['f'])
+            self.assertEqual([name for name, _, _ in self.ops.readdir('/d', None)], ['f'])
+            self.ops.access('/d/f', os.R_OK)
+            self.assertEqual(list_.call_count, 1)
+            self.assertEqual(status.call_count, 0)
+
+    def test_missing_paths_are_cached(self):
+        with mock.patch.object(self.client, 'status', wraps=self.client.status) as status:
+            for method in (self.ops.getattr, lambda path: self.ops.access(path, os.R_OK)):
+                with self.assertRaises(FuseOSError) as cm:
+                    method('/missing')
+                self.assertEqual(cm.exception.errno, errno.ENOENT)
+            self.assertEqual(status.call_count, 1)
+
+    def test_writes_are_refused(self):
+        calls = [
+            lambda: self.ops.chmod('/d/f', 0o600),
+            lambda: self.ops.chown('/d/f', 0, 0),
+            lambda: self.ops.mknod('/d/g', 0o644, 0),
+            lambda: self.ops.rmdir('/d'),
+            lambda: self.ops.mkdir('/e', 0o755),
+            lambda: self.ops.unlink('/d/f'),
+            lambda: self.ops.symlink('/d/g', '/d/f'),
+            lambda: self.ops.rename('/d/f', '/d/g'),
+            lambda: self.ops.link('/d/f', '/d/g'),
+            lambda: self.ops.utimens('/d/f', (0, 0)),
+            lambda: self.ops.create('/d/g', 0o644),
+            lambda: self.ops.write('/d/f', b'x', 0, 42),
+            lambda: self.ops.truncate('/d/f', 0),
+        ]
+        calls += [lambda flag=flag: self.ops.open('/d/f', os.O_RDONLY | flag)
+                  for flag in (os.O_WRONLY, os.O_RDWR, os.O_TRUNC, os.O_APPEND)]
+
+        for call in calls:
+            with self.assertRaises(FuseOSError) as cm:
+                call()
+            self.assertEqual(cm.exception.errno, errno.EROFS)
+
+        self.assertEqual(self.client.files, {'/root/d/f': self.DATA})
+        self.assertEqual(self.client.dirs, {'/root', '/root/d'})
+        self.assertEqual(self.ops.file_handle_fh, {})
+
+    def test_read_only_handle(self):
+        fh = self.ops.open('/d/f', os.O_RDONLY)
+        self.assertIsNone(self.ops.file_handle_p['/root/d/f']['tmp'])
+
+        self.assertEqual(self.ops.fsync('/d/f', None, fh), 0)
+        self.assertEqual(self.ops.flush('/d/f', fh), 0)
+        self.assertEqual(self.ops.release('/d/f', fh), 0)
+        self.assertEqual(self.ops.file_handle_p, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+import threading
+import time
+import unittest
+
+from locks import LockManager, RWLock
+
+
+TIMEOUT = 5
+
+
+def start(target, *args):
+    thread = threading.Thread(target=target, args=args, daemon=True)
+    thread.start()
+    return thread
+
+
+class RWLockTest(unittest.TestCase):
+    def test_readers_run_concurrently(self):
+        lock = RWLock()
+        barrier = threading.Barrier(2, timeout=TIMEOUT)
+
+        def reader():
+            lock.acquire_read()
+            try:
+                # Both readers must hold the lock at the same time to pass the barrier
+                barrier.wait()
+            finally:
+                lock.release_read()
+
+        threads = [start(reader) for _ in range(2)]
+        for thread in threads:
+            thread.join(TIMEOUT)
+        self.assertFalse(barrier.broken)
+
+    def test_writer_excludes_readers_and_writers(self):
+        lock = RWLock()
+        acquired = []
+
+        lock.acquire_write()
+        reader = start(lambda: (lock.acquire_read(), acquired.append('read'), lock.release_read()))
+        writer = start(lambda: (lock.acquire_write(), acquired.append('write'), lock.release_write()))
+        time.sleep(0.1)
+        self.assertEqual(acquired, [])
+
+        lock.release_write()
+        reader.join(TIMEOUT)
+        writer.join(TIMEOUT)
+        self.assertCountEqual(acquired, ['read', 'write'])
+
+    def test_waiting_writer_has_priority_over_new_readers(self):
+        lock = RWLock()
+        order = []
+
+        lock.acquire_read()
+        writer = start(lambda: (lock.acquire_write(), order.append('write'), lock.release_write()))
+        while lock._waiting_writers == 0:
+            time.sleep(0.01)
+
+        reader = start(lambda: (lock.acquire_read(), order.append('read'), lock.release_read()))
+        time.sleep(0.1)
+        # The new reader must not get in while the writer is waiting
+        self.assertEqual(order, [])
+
+        lock.release_read()
+        writer.join(TIMEOUT)
+        reader.join(TIMEOUT)
+        self.assertEqual(order, ['write', 'read'])
+
+
+class LockManagerTest(unittest.TestCase):
+    def test_reads_on_same_path_run_concurrently(self):
+        locks = LockManager()
+        barrier = threading.Barrier(2, timeout=TIMEOUT)
+
+        def reader():
+            with locks.read('/a'):
+                barrier.wait()
+
+        threads = [start(reader) for _ in range(2)]
+        for thread in threads:
+            thread.join(TIMEOUT)
+        self.assertFalse(barrier.broken)
+
+    def test_write_on_other_path_does_not_block(self):
+        locks = LockManager()
+        done = threading.Event()
+
+        def writer():
+            with locks.write('/b'):
+                done.set()
+
+        with locks.write('/a'):
+            start(writer)
+            self.assertTrue(done.wait(TIMEOUT))
+
+    def test_multi_path_writes_do_not_deadlock(self):
+        locks = LockManager()
+
+        def writer(*paths):
+            for _ in range(200):
+                with locks.write(*paths):
+                    pass
+
+        threads = [start(writer, '/a', '/b'), start(writer, '/b', '/a'), start(writer, '/b', '/a', '/b')]
+        for thread in threads:
+            thread.join(TIMEOUT)
+            self.assertFalse(thread.is_alive())
+
+    def test_path_locks_are_dropped_after_use(self):
+        locks = LockManager()
+
+        with locks.read('/a'):
+            with locks.read('/a'):
+                self.assertEqual(list(locks._paths), ['/a'])
+        with locks.write('/a', '/b'):
+            self.assertCountEqual(locks._paths, ['/a', '/b'])
+        with self.assertRaises(ValueError):
+            with locks.write('/c'):
+                raise ValueError()
+
+        self.assertEqual(locks._paths, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
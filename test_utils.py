@@ -0,0 +1,20 @@
+import unittest
+
+from utils import is_snapshot_path
+
+
+class IsSnapshotPathTest(unittest.TestCase):
+    def test_snapshot_paths(self):
+        self.assertTrue(is_snapshot_path('/data/.snapshot/s1'))
+        self.assertTrue(is_snapshot_path('/data/.snapshot'))
+        self.assertTrue(is_snapshot_path('/data/.snapshot/s1/sub/'))
+
+    def test_other_paths(self):
+        self.assertFalse(is_snapshot_path('/'))
+        self.assertFalse(is_snapshot_path('/data/set'))
+        self.assertFalse(is_snapshot_path('/data/.snapshots'))
+        self.assertFalse(is_snapshot_path('/data/my.snapshot'))
+
+
+if __name__ == '__main__':
+    unittest.main()
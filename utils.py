@@ -81,3 +81,10 @@ def stat_to_attrs(stat, hdfs_user, hdfs_group):
 def has_access(stat, mode):
     st_mode = to_st_mode(stat['permission'], stat['type'])
     return st_mode & mode > 0
+
+
+def is_snapshot_path(path):
+    """
+    Returns True if the path is inside an HDFS snapshot (i.e. one of its components is ".snapshot").
+    """
+    return '.snapshot' in path.strip('/').split('/')